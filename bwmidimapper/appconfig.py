@@ -1,120 +1,210 @@
 #!/usr/bin/env python
 
-"""bwConfigHandler - A class to handle configurations in bwMIDIMapper."""
+"""bwConfigHandler - Functions to handle configurations in bwMIDIMapper."""
 
 # Python imports
 import argparse  # Parser for command-line options, arguments and subcommands
-import csv  # CSV File Reading and Writing
+import functools  # Higher-order functions and operations on callable objects
+import os  # Miscellaneous operating system interfaces
 import re  # Regular expression operations
+import struct  # Interpret bytes as packed binary data
 
 # Local imports
-from typing import Tuple, Dict
+from typing import Dict, Optional, Tuple
 
+# RegEx for time signatures
+_TS_RE = re.compile(r"^(\d+)\/(\d+)$")
 
-class AppConfig:
+# Valid beat units, as a set for lookups and as a tuple for error messages
+_BEAT_UNITS = frozenset((1, 2, 4, 8, 16, 32))
+_BEAT_UNITS_DISPLAY = (1, 2, 4, 8, 16, 32)
 
-    """A class to handle configurations in bwMIDIMapper."""
+# Drum mapping cache file suffix, header (CSV mtime in ns and size) and unmapped note value
+_CACHE_SUFFIX = ".lut"
+_CACHE_HEADER = struct.Struct("<qq")
+_CACHE_UNMAPPED = 0xFF
 
-    def __init__(self):
+# Bundled drum mapping directory, cache files are never written into the installed package
+_PACKAGE_DATA_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), "data"))
+
+
+def _read_cache(cache_file: str, header: bytes) -> Optional[Dict[int, int]]:
+
+    """Read drum mapping from a cache file, or return None if it is missing or stale."""
+
+    # Read cache file
+    try:
+        with open(cache_file, mode="rb") as fh:
+            data = fh.read()
+    except OSError:
+        return None
+
+    # Check that the cache file matches the CSV file and has a full lookup table
+    if len(data) != len(header) + 128 or not data.startswith(header):
+        return None
+
+    # Check that each output note is a valid note (0-127) or unmapped, a corrupt cache is stale
+    lut = data[len(header):]
+    if any(127 < output_note < _CACHE_UNMAPPED for output_note in lut):
+        return None
+
+    # Return drum map
+    return {
+        input_note: output_note
+        for input_note, output_note in enumerate(lut)
+        if output_note != _CACHE_UNMAPPED
+    }
+
+
+def _write_cache(cache_file: str, header: bytes, drum_map: Dict[int, int]) -> None:
+
+    """Write drum mapping to a cache file as a 128-byte lookup table."""
+
+    # Build lookup table indexed by input note
+    lut = bytearray([_CACHE_UNMAPPED]) * 128
+    for input_note, output_note in drum_map.items():
+        lut[input_note] = output_note
+
+    # Write cache file, the CSV file's directory may not be writable
+    try:
+        with open(cache_file, mode="wb") as fh:
+            fh.write(header + lut)
+    except OSError:
         pass
 
-    def time_signature(self, ts: str) -> Tuple[int, int]:
 
-        """
-        Parse and validate a time signature string like "4/4".
+def time_signature(ts: str) -> Tuple[int, int]:
+
+    """
+    Parse and validate a time signature string like "4/4".
+
+    :param ts: Time signature for output MIDI file, eg. 4/4.
+    :type ts: str
+
+    :return: Tuple[int, int]
+    """
+
+    # Match time signature using RegEx
+    ts_match = _TS_RE.match(ts)
+
+    # Check RegEx match
+    if not ts_match:
+        raise argparse.ArgumentTypeError(
+            f"Invalid time signature: '{ts}'. Expected format: N/D (e.g. 4/4)"
+        )
+
+    # Grab beats and units from RegEx match
+    beats, unit = int(ts_match.group(1)), int(ts_match.group(2))
+
+    # Validate beats and unit
+    if beats < 1:
+        raise argparse.ArgumentTypeError(
+            f"Invalid beats-per-bar: {beats}. Beats-per-bar must be >= 1."
+        )
+    if unit not in _BEAT_UNITS:
+        raise argparse.ArgumentTypeError(
+            f"Invalid beat unit: {unit}. Allowed beat units: {_BEAT_UNITS_DISPLAY}."
+        )
+
+    # Return beats and unit
+    return (beats, unit)
+
+
+def _parse_mapping(mapping_file: str) -> Dict[int, int]:
+
+    """Parse drum mapping from a CSV file."""
+
+    # Declare variables
+    drum_map: Dict[int, int] = {}
+
+    # Read drum mapping from CSV file as plain text, only the first two cells are needed
+    with open(mapping_file, encoding="UTF-8", mode="r") as fh:
 
-        :param ts: Time signature for output MIDI file, eg. 4/4.
-        :type ts: str
+        # Loop each line
+        for line in fh:
 
-        :return: Tuple[int, int]
-        """
+            # Split the first two cells from the rest of the line
+            cells = line.split(",", 2)
 
-        # Declare variables
-        beat_units = [1, 2, 4, 8, 16, 32]  # Valid beat units
-        ts_regex = re.compile(r"^(\d+)\/(\d+)$")  # RegEx for time signatures
+            # Skip empty lines and lines with a single cell
+            if len(cells) < 2:
+                continue
 
-        # Match time signature using RegEx
-        ts_match = ts_regex.match(ts)
+            # Support files with headers by skipping non-numeric first cell
+            input_note_raw = cells[0].strip().strip('"').strip()
+            output_note_raw = cells[1].strip().strip('"').strip()
 
-        # Check RegEx match
-        if not ts_match:
-            raise argparse.ArgumentTypeError(
-                f"Invalid time signature: '{ts}'. Expected format: N/D (e.g. 4/4)"
-            )
+            # Skip mappings with empty input or output notes
+            if not input_note_raw or not output_note_raw:
+                continue
 
-        # Grab beats and units from RegEx match
-        beats, unit = int(ts_match.group(1)), int(ts_match.group(2))
+            # Check if input and output notes are 1-3 digit numbers
+            if not (input_note_raw.isdecimal() and output_note_raw.isdecimal()
+                    and len(input_note_raw) <= 3 and len(output_note_raw) <= 3):
 
-        # Validate beats and unit
-        if beats < 1:
-            raise argparse.ArgumentTypeError(
-                f"Invalid beats-per-bar: {beats}. Beats-per-bar must be >= 1."
-            )
-        if unit not in beat_units:
-            raise argparse.ArgumentTypeError(
-                f"Invalid beat unit: {unit}. Allowed beat units: {beat_units}."
-            )
+                # Skip header rows or malformed rows
+                continue
 
-        # Return beats and unit
-        return (beats, unit)
+            # Convert input and output notes to integer values
+            input_note = int(input_note_raw)
+            output_note = int(output_note_raw)
 
-    # Drum mapping
-    def read_mapping(self, mapping_file: str) -> Dict[int, int]:
+            # Validate note numbers (0-127)
+            if not 0 <= input_note <= 127:
+                continue
+            if not 0 <= output_note <= 127:
+                continue
 
-        """Reads drum mapping from a CSV file.
+            # Add mapping to drum map
+            drum_map[input_note] = output_note
 
-        :param mapping_file: Input CSV file containing drum mapping.
-        :type mapping_file: str
+    # Return drum map
+    return drum_map
 
-        :return: Dict[int, int]
-        """
 
-        # Declare variables
-        drum_map: Dict[int, int] = {}
-        note_regex = re.compile(r"^\d{1,3}$")  # Allow 0-127 numeric strings
+@functools.lru_cache(maxsize=32)
+def _read_mapping_cached(
+    mapping_file: str, mtime_ns: int, size: int
+) -> Tuple[Tuple[int, int], ...]:
 
-        # Read drum mapping from CSV file
-        with open(mapping_file, encoding="UTF-8", mode="r", newline="") as fh:
+    """Read drum mapping through the cache file, memoized by CSV path, mtime and size."""
 
-            # Open CSV file
-            csv_file = csv.reader(fh, delimiter=",", quotechar='"')
+    # Bundled drum mappings are only memoized, the cache file would be left in the package
+    if os.path.dirname(os.path.realpath(mapping_file)) == _PACKAGE_DATA_DIR:
+        return tuple(_parse_mapping(mapping_file).items())
 
-            # Loop each line
-            for line in csv_file:
+    # Read drum mapping from cache file if it is up to date, otherwise parse the CSV file
+    header = _CACHE_HEADER.pack(mtime_ns, size)
+    cache_file = mapping_file + _CACHE_SUFFIX
+    drum_map = _read_cache(cache_file, header)
+    if drum_map is None:
+        drum_map = _parse_mapping(mapping_file)
+        _write_cache(cache_file, header, drum_map)
 
-                # Skip empty lines
-                if not line:
-                    continue
+    # Return drum map as immutable pairs so the memoized value can not be modified
+    return tuple(drum_map.items())
 
-                # Support files with headers by skipping non-numeric first cell
-                input_note_raw = line[0].strip() if len(line) >= 1 else ""
-                output_note_raw = line[1].strip() if len(line) >= 2 else ""
 
-                # Skip mappings with empty input or output notes
-                if not input_note_raw or not output_note_raw:
-                    continue
+# Drum mapping
+def read_mapping(mapping_file: str, use_cache: bool = True) -> Dict[int, int]:
 
-                # Check if input and output notes match 1-3 digit number
-                if not note_regex.match(input_note_raw) or not note_regex.match(output_note_raw):
+    """Reads drum mapping from a CSV file.
 
-                    # Skip header rows or malformed rows
-                    continue
+    The parsed mapping is cached in memory and, except for the bundled
+    mapping, next to the CSV file, and reused until the CSV file changes.
 
-                # Convert input and output notes to integer values
-                try:
-                    input_note = int(input_note_raw)
-                    output_note = int(output_note_raw)
-                except ValueError:
-                    continue
+    :param mapping_file: Input CSV file containing drum mapping.
+    :type mapping_file: str
+    :param use_cache: Read and write the drum mapping caches.
+    :type use_cache: bool
 
-                # Validate note numbers (0-127)
-                if not 0 <= input_note <= 127:
-                    continue
-                if not 0 <= output_note <= 127:
-                    continue
+    :return: Dict[int, int]
+    """
 
-                # Add mapping to drum map
-                drum_map[input_note] = output_note
+    # Parse CSV file directly without caches
+    if not use_cache:
+        return _parse_mapping(mapping_file)
 
-        # Return drum map
-        return drum_map
+    # Return a new drum map from the cached pairs, keyed by the CSV file's current state
+    stat = os.stat(mapping_file)
+    return dict(_read_mapping_cached(os.fspath(mapping_file), stat.st_mtime_ns, stat.st_size))
@@ -8,7 +8,7 @@ This project is licensed under the GPLv3 License.
 SPDX-License-Identifier: GPL-3.0-or-later
 
 Usage:
-python bwmidimapper.py "infile.mid" "outfile.mid" --force-percussion \
+python -m bwmidimapper.main "infile.mid" "outfile.mid" --force-percussion \
     --log-level DEBUG --tempo 140 --time-signature 7/4 --remove-duplicates
 """
 
@@ -16,11 +16,10 @@ python bwmidimapper.py "infile.mid" "outfile.mid" --force-percussion \
 import argparse  # Parser for command-line options, arguments and subcommands
 import logging  # Logging facility for Python
 import sys  # System-specific parameters and functions
-from importlib.resources import files  # The implementation of import
 from pathlib import Path  # Object-oriented filesystem paths
 
 # bwMIDIMapper imports
-from .appconfig import AppConfig
+from .appconfig import read_mapping, time_signature
 from .midihandler import MIDIHandler
 
 
@@ -30,10 +29,6 @@ def main(argv=None):
 
     # Declare variables
     map_file = "ad2gm.csv"
-    map_path = files("bwmidimapper").joinpath("data").joinpath("ad2gm.csv")
-
-    # Initialize AppConfig instance
-    appconfig = AppConfig()
 
     # Initialize ArgumentParser
     parser = argparse.ArgumentParser(
@@ -43,7 +38,7 @@ def main(argv=None):
     # Define arguments
     parser.add_argument("infile", type=str, help="Input MIDI file with source drum mapping.")
     parser.add_argument("outfile", type=str, help="Output MIDI file with target drum mapping.")
-    parser.add_argument("--drum-map", default=map_path, type=str,
+    parser.add_argument("--drum-map", default=None, type=str,
                         help=f"Drum mapping file. Default is: '{map_file}'.")
     parser.add_argument("--discard-unmapped", action="store_true",
                         help="Discard notes that are not defined in the drum map.")
@@ -52,13 +47,18 @@ def main(argv=None):
     parser.add_argument("--log-level", default="INFO",
                         choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
                         help="Logging verbosity level.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not read or write the drum mapping cache file.")
     parser.add_argument("--preserve-meta", action="store_true",
                         help="Preserve tempo/time signature meta events from source file (may " +
                              "create duplicates meta events).")
     parser.add_argument("--remove-duplicates", action="store_true", help="Remove duplicate notes.")
+    parser.add_argument("--streaming-write", action="store_true",
+                        help="Write output MIDI file track by track instead of building it in " +
+                             "memory first.")
     parser.add_argument("--tempo", default=None, type=int,
                         help="Tempo for output MIDI file, e.g. 120.")
-    parser.add_argument("--time-signature", default=None, type=appconfig.time_signature,
+    parser.add_argument("--time-signature", default=None, type=time_signature,
                         help="Time signature for output MIDI file, eg. 4/4.")
 
     # Parse arguments
@@ -82,16 +82,23 @@ def main(argv=None):
             logging.error("Tempo out of range: %s. Must be 20-300 BPM.", args.tempo)
             sys.exit(2)
 
+    # Resolve default drum mapping file only after the arguments have been validated
+    drum_map_path = args.drum_map
+    if drum_map_path is None:
+        # Import resources lazily, it is not needed when a drum mapping file is given
+        from importlib.resources import files  # pylint: disable=C0415
+        drum_map_path = str(files("bwmidimapper").joinpath(f"data/{map_file}"))
+
     # Read drum mapping
     try:
-        drum_map = appconfig.read_mapping(args.drum_map)
+        drum_map = read_mapping(drum_map_path, use_cache=not args.no_cache)
     except Exception as exc:  # pylint: disable=W0718
-        logging.exception("AppConfig failed: %s", exc)
+        logging.exception("Reading drum mapping failed: %s", exc)
         sys.exit(1)
 
-    # Process MIDI data using bwMIDIHandler
-    midihandler = MIDIHandler(args, drum_map)
+    # Process MIDI data using bwMIDIHandler, which also validates the drum mapping
     try:
+        midihandler = MIDIHandler(args, drum_map)
         midihandler.process_file(args.infile, args.outfile)
     except Exception as exc:  # pylint: disable=W0718
         logging.exception("Conversion failed: %s", exc)
@@ -4,24 +4,44 @@
 
 # Python imports
 import argparse  # Parser for command-line options, arguments and subcommands
+import io  # Core tools for working with streams
 import logging  # Logging facility for Python
+from pathlib import Path  # Object-oriented filesystem paths
 
 # Local imports
-from typing import Optional, Dict
+from typing import Dict, List
 
 # 3rd party imports
 import mido  # MIDI Objects for Python
 
+# Module logger
+log = logging.getLogger(__name__)
+
+# Drum lookup table value for notes that are not defined in the drum map
+_UNMAPPED = 0xFF
+
 
 class MIDIHandler:  # pylint: disable=R0903
 
     """A class to handle MIDI processing in bwMIDIMapper."""
 
     def __init__(self, args: argparse.Namespace, drum_map: Dict[int, int]):
+
+        # Validate drum map once, remapped notes are written without mido's value checks
+        for input_note, output_note in drum_map.items():
+            if not (0 <= input_note <= 127 and 0 <= output_note <= 127):
+                raise ValueError(
+                    f"Invalid drum mapping: {input_note} -> {output_note}. "
+                    "Notes must be in range 0..127."
+                )
+
         self.args = args  # Arguments
         self.drum_map = drum_map  # Drum mapping to use while processing
+        self.drum_lut = bytes(  # Drum mapping indexed by note number
+            drum_map.get(note, _UNMAPPED) for note in range(128)
+        )
         self.percussion_channel = 9  # Channel 10 = percussions, 0-based index
-        self.active_notes = {}  # Active notes dict to identify duplicate notes
+        self.active_notes = set()  # Active notes set to identify duplicate notes
 
     def _insert_meta(self, new_track: mido.MidiTrack) -> None:
 
@@ -38,101 +58,147 @@ class MIDIHandler:  # pylint: disable=R0903
                 mido.MetaMessage("time_signature", numerator=ts[0], denominator=ts[1], time=0)
             )
 
-    def _process_note(self, msg: mido.Message) -> Optional[mido.Message]:
-
-        """Process MIDI notes in MIDIHandler."""
-
-        # Duplicate-note handling
-        if self.args.remove_duplicates:
-            active_note = (msg.channel, msg.note)
-            if msg.type == "note_on" and getattr(msg, "velocity", 0) > 0:
-                if active_note in self.active_notes:
-                    logging.info("Duplicate note, channel='%s', note='%s'", msg.channel, msg.note)
-                    return None
-                self.active_notes[active_note] = msg
-            elif msg.type == "note_off":
-                if active_note in self.active_notes:
-                    del self.active_notes[active_note]
-            elif msg.type == "note_on" and getattr(msg, "velocity", 0) == 0:
-                self.active_notes.pop(active_note, None)
-
-        # Copy message (preserve time)
-        new_msg = msg.copy()
-
-        # Map notes
-        original = getattr(msg, "note", None)
-        if original is not None:
-            mapped = self.drum_map.get(original, None)
-        else:
-            mapped = None
-
-        # Note is found in the drum map
-        if mapped is not None:
-            new_msg.note = mapped
-        # Discard unmapped notes
-        elif self.args.discard_unmapped and mapped is None:
-            logging.info("Discarding note %s because it is not defined in DrumMap.", original)
-            new_msg = None
-        # Keep unmapped notes
-        else:
-            logging.debug(
-                "Keeping note %s as intact because it is not defined in DrumMap.", original
-            )
-
-        # Set percussion channel
-        if hasattr(new_msg, "channel") and self.args.force_percussion:
-            logging.info(
-                "Percussion channel %s is forced to note %s", self.percussion_channel + 1, original
-            )
-            new_msg.channel = self.percussion_channel
+    def _process_track(  # pylint: disable=R0912,R0914,R0915
+        self, track: mido.MidiTrack
+    ) -> List[mido.Message]:
+
+        """Process a single MIDI track in MIDIHandler."""
+
+        # Bind attributes used in the message loop to locals
+        remove_duplicates = self.args.remove_duplicates
+        discard_unmapped = self.args.discard_unmapped
+        force_percussion = self.args.force_percussion
+        preserve_meta = self.args.preserve_meta
+        percussion_channel = self.percussion_channel
+        drum_lut = self.drum_lut
+        active_notes = self.active_notes
+        info_enabled = log.isEnabledFor(logging.INFO)
+        debug_enabled = log.isEnabledFor(logging.DEBUG)
+
+        # Pass the track on as-is when none of its messages would change, unless per-note
+        # debug logging is wanted
+        if preserve_meta and not force_percussion and not remove_duplicates and not debug_enabled:
+            track_notes = {msg.note for msg in track if msg.type in ("note_on", "note_off")}
+            if track_notes.isdisjoint(self.drum_map) and not (discard_unmapped and track_notes):
+                return track
+
+        # Collect output messages for the whole track in one pass
+        messages = []
+        append = messages.append
+
+        for msg in track:
+            msg_type = msg.type
+
+            # Process note messages
+            if msg_type in ("note_on", "note_off"):
+                note = msg.note
+                channel = msg.channel
+
+                # Duplicate-note handling
+                if remove_duplicates:
+                    # Pack channel (4 bits) and note (7 bits) into a single int key
+                    active_note = (channel << 7) | note
+                    if msg_type == "note_on" and msg.velocity > 0:
+                        if active_note in active_notes:
+                            log.info("Duplicate note, channel='%s', note='%s'", channel, note)
+                            continue
+                        active_notes.add(active_note)
+                    else:
+                        # note_off or note_on with zero velocity
+                        active_notes.discard(active_note)
+
+                # Map notes, note_on and note_off messages always have a note in the 0-127 range
+                mapped = drum_lut[note]
+                if mapped == _UNMAPPED:
+
+                    # Discard unmapped notes
+                    if discard_unmapped:
+                        if info_enabled:
+                            log.info(
+                                "Discarding note %s because it is not defined in DrumMap.", note
+                            )
+                        continue
+
+                    # Keep unmapped notes
+                    if debug_enabled:
+                        log.debug(
+                            "Keeping note %s as intact because it is not defined in DrumMap.", note
+                        )
+                    mapped = note
+
+                # Set percussion channel
+                new_channel = channel
+                if force_percussion:
+                    if info_enabled:
+                        log.info(
+                            "Percussion channel %s is forced to note %s",
+                            percussion_channel + 1, note
+                        )
+                    new_channel = percussion_channel
 
-        return new_msg
+                # Messages are never mutated after they are emitted, so unchanged notes are
+                # passed on as-is and only notes with a changed field are copied (preserve time)
+                if mapped == note and new_channel == channel:
+                    append(msg)
+                else:
+                    # Copy without validation, drum map notes and channels are already in range
+                    new_msg = msg.copy()
+                    vars(new_msg).update(note=mapped, channel=new_channel)
+                    append(new_msg)
+
+            # Process meta messages
+            elif msg.is_meta:
+                if preserve_meta:
+                    append(msg)
+                elif debug_enabled:
+                    log.debug(
+                        "Skipping meta message %s (preserve_meta=%s).", msg_type, preserve_meta
+                    )
+            else:
+                # Other channel messages are kept unchanged
+                append(msg)
+
+        return messages
 
     def process_file(self, infile: str, outfile: str) -> None:
 
         """Process MIDI files in MIDIHandler."""
 
-        # Read input MIDI file
-        mid = mido.MidiFile(infile)
+        # Read input MIDI file at once and parse it from memory, mido reads byte by byte.
+        # Clip out-of-range data bytes instead of failing.
+        mid = mido.MidiFile(file=io.BytesIO(Path(infile).read_bytes()), clip=True)
 
         # Preserve ticks per beat
         new_mid = mido.MidiFile(ticks_per_beat=mid.ticks_per_beat)
 
-        # Process MIDI tracks
-        for track_index, track in enumerate(mid.tracks):
+        # Process the first MIDI track, the only one that may get user-specified metas
+        tracks = iter(mid.tracks)
+        first_track = next(tracks, None)
+        if first_track is not None:
             new_track = mido.MidiTrack()
 
             # Insert metas in track 0 unless preserving source metas
-            if track_index == 0 and not self.args.preserve_meta:
+            if not self.args.preserve_meta:
                 self._insert_meta(new_track)
 
+            # Transform the track as a batch and extend the new track once
+            new_track.extend(self._process_track(first_track))
             new_mid.tracks.append(new_track)
 
-            for msg in track:
-                # Process note messages
-                if msg.type in ("note_on", "note_off"):
-                    logging.info("Note %s", msg)
-                    new_msg = self._process_note(msg)
-                    if new_msg is not None:
-                        new_track.append(new_msg)
-
-                # Process meta messages
-                elif msg.is_meta:
-                    if self.args.preserve_meta:
-                        new_track.append(msg.copy())
-                    else:
-                        logging.debug(
-                            "Skipping meta message %s (preserve_meta=%s).",
-                            msg.type, self.args.preserve_meta
-                        )
-                else:
-                    # Other channel messages are kept unchanged
-                    new_track.append(msg.copy())
+        # Process the remaining MIDI tracks
+        for track in tracks:
+            new_mid.tracks.append(mido.MidiTrack(self._process_track(track)))
 
-            # Ensure explicit end_of_track meta is present for this new track
-            if self.args.preserve_meta:
-                new_track.append(mido.MetaMessage("end_of_track", time=0))
+        # Ensure explicit end_of_track meta is present for each new track
+        if self.args.preserve_meta:
+            for new_track in new_mid.tracks:
+                new_track.append(mido.MetaMessage("end_of_track", skip_checks=True, time=0))
 
-        # Save output MIDI file
-        new_mid.save(outfile)
-        logging.info("New MIDI file saved as: %s", outfile)
+        # Save output MIDI file, built in memory and written at once unless streaming
+        if self.args.streaming_write:
+            new_mid.save(outfile)
+        else:
+            buffer = io.BytesIO()
+            new_mid.save(file=buffer)
+            Path(outfile).write_bytes(buffer.getbuffer())
+        log.info("New MIDI file saved as: %s", outfile)
@@ -12,6 +12,7 @@ pytest -q test_bwmidimapper.py
 # Python imports
 import argparse  # Parser for command-line options, arguments and subcommands
 import io  # Core tools for working with streams
+import itertools  # Functions creating iterators for efficient looping
 import os  # Miscellaneous operating system interfaces
 import tempfile  # Generate temporary files and directories
 from pathlib import Path  # Object-oriented filesystem paths
@@ -21,33 +22,69 @@ import mido  # MIDI Objects for Python
 import pytest  # Simple powerful testing with Python
 
 # bwMIDIMapper imports
-from bwmidimapper.appconfig import AppConfig
+from bwmidimapper import appconfig
+from bwmidimapper.appconfig import read_mapping
 from bwmidimapper.midihandler import MIDIHandler
 
+# Meta messages for sample MIDI files
+_TEMPO = mido.bpm2tempo(120)
+_TEMPO_MSG = mido.MetaMessage("set_tempo", tempo=_TEMPO, time=0)
+_TS_MSG = mido.MetaMessage("time_signature", numerator=4, denominator=4, time=0)
+
+# Note messages for sample MIDI files as (type, note, time, channel)
+_SAMPLE_NOTES = (
+    # Mapped notes
+    ("note_on", 36, 0, 9),
+    ("note_off", 36, 240, 9),
+    ("note_on", 38, 0, 0),
+    ("note_off", 38, 240, 0),
+    # Duplicate note while the first one is active and the same note again after release
+    ("note_on", 36, 0, 9),
+    ("note_on", 36, 0, 9),
+    ("note_off", 36, 240, 9),
+    ("note_on", 36, 0, 9),
+    ("note_off", 36, 240, 9),
+    # Note that is not defined in the drum mapping
+    ("note_on", 42, 0, 0),
+    ("note_off", 42, 240, 0),
+)
+
+# Note messages for a second sample track, none are defined in the drum mapping
+_UNMAPPED_NOTES = (
+    ("note_on", 42, 0, 0),
+    ("note_off", 42, 240, 0),
+    ("note_on", 46, 0, 0),
+    ("note_off", 46, 240, 0),
+)
+
+# MIDI message types that have a note
+_NOTE_TYPES = frozenset(("note_on", "note_off"))
+
 
 def write_sample_csv(path: Path):
     """Write a simple MIDI drum mapping CSV file."""
 
     with open(path, "w", newline="", encoding="UTF-8") as fh:
-        fh.write('"INP","OUT","AD2","GM"\n')
-        fh.write('"---","---","---","--"\n')
-        fh.write('"036","036","Kick","Electric Bass Drum"\n')
-        fh.write('"038","040","Snare Open Hit","Electric Snare or Rimshot"\n')
-        fh.write('\n')
+        fh.write(
+            '"INP","OUT","AD2","GM"\n'
+            '"---","---","---","--"\n'
+            '"036","036","Kick","Electric Bass Drum"\n'
+            '"038","040","Snare Open Hit","Electric Snare or Rimshot"\n'
+            '\n'
+        )
+
+    # Return CSV file path
+    return path
 
 
 def test_read_mapping_accepts_valid_csv(tmp_path):
     """Test reading simple MIDI drum mapping CSV file."""
 
-    # Initialize AppConfig instance
-    appconfig = AppConfig()
-
     # Create a new MIDI drum mapping file
-    csv_path = os.path.join(tmp_path, "mapping.csv")
-    write_sample_csv(csv_path)
+    csv_path = write_sample_csv(tmp_path / "mapping.csv")
 
     # Read drum mapping file
-    mapping = appconfig.read_mapping(str(csv_path))
+    mapping = read_mapping(str(csv_path))
 
     # Check if drum mappings are valid
     assert isinstance(mapping, dict)
@@ -58,6 +95,66 @@ def test_read_mapping_accepts_valid_csv(tmp_path):
     assert all(0 <= k <= 127 and 0 <= v <= 127 for k, v in mapping.items())
 
 
+def test_read_mapping_uses_cache(tmp_path):
+    """Test reading MIDI drum mapping from a cache file."""
+
+    # Create a new MIDI drum mapping file
+    csv_path = write_sample_csv(tmp_path / "mapping.csv")
+    cache_path = tmp_path / "mapping.csv.lut"
+
+    # Read drum mapping file without cache
+    mapping = read_mapping(str(csv_path), use_cache=False)
+    assert not cache_path.exists()
+
+    # Read drum mapping file and check that the cache file is written
+    assert read_mapping(str(csv_path)) == mapping
+    assert cache_path.exists()
+
+    # Read drum mapping again from the in-memory cache and check that it is a new dict
+    cached_mapping = read_mapping(str(csv_path))
+    assert cached_mapping == mapping
+    cached_mapping[1] = 1
+    assert read_mapping(str(csv_path)) == mapping
+
+    # Rewrite drum mapping file with same-size content and restore its mtime, so only the
+    # cache file still has the old mapping
+    csv_stat = csv_path.stat()
+    csv_path.write_bytes(csv_path.read_bytes().replace(b'"038","040"', b'"038","041"'))
+    os.utime(csv_path, ns=(csv_stat.st_atime_ns, csv_stat.st_mtime_ns))
+    assert csv_path.stat().st_size == csv_stat.st_size
+
+    # Clear the in-memory cache and check that the old mapping is read from the cache file
+    appconfig._read_mapping_cached.cache_clear()  # pylint: disable=W0212
+    assert read_mapping(str(csv_path)) == mapping
+    assert read_mapping(str(csv_path), use_cache=False).get(38) == 41
+
+    # Corrupt the cache file and check that it is treated as stale and rewritten
+    appconfig._read_mapping_cached.cache_clear()  # pylint: disable=W0212
+    cache_data = bytearray(cache_path.read_bytes())
+    cache_data[-128 + 38] = 200
+    cache_path.write_bytes(cache_data)
+    assert read_mapping(str(csv_path)).get(38) == 41
+    assert cache_path.read_bytes()[-128 + 38] == 41
+
+    # Change drum mapping file and check that the stale cache file is not used
+    with open(csv_path, "a", newline="", encoding="UTF-8") as fh:
+        fh.write('"040","041","Snare Open Hit (double)","Low Floor Tom"\n')
+    mapping = read_mapping(str(csv_path))
+    assert mapping.get(40) == 41
+
+
+def test_read_mapping_does_not_cache_bundled_csv():
+    """Test that no cache file is written into the package for the default drum mapping."""
+
+    # Read the default drum mapping file
+    csv_path = Path(appconfig.__file__).parent / "data" / "ad2gm.csv"
+    mapping = read_mapping(str(csv_path))
+
+    # Check that the drum mapping was read and no cache file was written
+    assert mapping.get(36) == 35
+    assert not csv_path.with_name(csv_path.name + ".lut").exists()
+
+
 def create_simple_midi(path: Path):
     """Create a simple MIDI file for testing."""
 
@@ -67,16 +164,16 @@ def create_simple_midi(path: Path):
     outfile_midi.tracks.append(track)
 
     # Set tempo meta message
-    track.append(mido.MetaMessage("set_tempo", tempo=mido.bpm2tempo(120), time=0))
+    track.append(_TEMPO_MSG.copy())
 
     # Set time signature meta message
-    track.append(mido.MetaMessage("time_signature", numerator=4, denominator=4, time=0))
+    track.append(_TS_MSG.copy())
 
-    # Set some note messages
-    track.append(mido.Message("note_on", note=36, velocity=64, time=0, channel=9))
-    track.append(mido.Message("note_off", note=36, velocity=64, time=240, channel=9))
-    track.append(mido.Message("note_on", note=38, velocity=64, time=0, channel=0))
-    track.append(mido.Message("note_off", note=38, velocity=64, time=240, channel=0))
+    # Set note messages, the constant values are known to be valid
+    for msg_type, note, time, channel in _SAMPLE_NOTES:
+        track.append(mido.Message(
+            msg_type, skip_checks=True, note=note, velocity=64, time=time, channel=channel
+        ))
 
     # Save output MIDI file
     outfile_midi.save(path)
@@ -85,65 +182,106 @@ def create_simple_midi(path: Path):
     return path
 
 
-def test_convert_midi_basic_mapping(tmp_path):
-    """Test converting MIDI mapping."""
+def create_multitrack_midi(path: Path):
+    """Create a MIDI file for testing with a second track of unmapped notes."""
 
-    # Declare variables
-    csv_path: str = os.path.join(tmp_path, "mapping.csv")  # CSV drum mapping
-    infile: str = os.path.join(tmp_path, "infile.mid")  # Input MIDI file
-    infile_path = Path(infile)  # Input MIDI file Path object
-    outfile: str = os.path.join(tmp_path, "outfile.mid")  # Output MIDI file
-    outfile_midi: None = None  # Output MIDI file data
-    outfile_path = Path(outfile)  # Output MIDI file Path object
-    messages: list = []  # MIDI messages
+    # Read the simple MIDI file and add a second track
+    outfile_midi = mido.MidiFile(create_simple_midi(path))
+    track = mido.MidiTrack()
+    outfile_midi.tracks.append(track)
+
+    # Set time signature meta message
+    track.append(_TS_MSG.copy())
+
+    # Set note messages, the constant values are known to be valid
+    for msg_type, note, time, channel in _UNMAPPED_NOTES:
+        track.append(mido.Message(
+            msg_type, skip_checks=True, note=note, velocity=64, time=time, channel=channel
+        ))
+
+    # Save output MIDI file
+    outfile_midi.save(path)
+
+    # Return output MIDI file path
+    return path
+
+
+def note_messages(midi_file: mido.MidiFile) -> list:
+    """Return note messages from all tracks of a MIDI file."""
+
+    return [m for m in itertools.chain.from_iterable(midi_file.tracks) if m.type in _NOTE_TYPES]
 
-    # Initialize AppConfig
-    appconfig = AppConfig()
 
-    # Generate a sample drum mapping CSV file
-    write_sample_csv(csv_path)
+def make_args(infile: Path, outfile: Path, **overrides) -> argparse.Namespace:
+    """Return MIDIHandler arguments with the CLI defaults, source metas preserved."""
 
-    # Generate a sample MIDI file
-    create_simple_midi(infile)
+    # Command-line defaults, tests override only the flags they check
+    args = {
+        "discard_unmapped": False,
+        "force_percussion": False,
+        "preserve_meta": True,
+        "remove_duplicates": False,
+        "streaming_write": False,
+        "tempo": None,
+        "time_signature": None,
+    }
+    args.update(overrides)
 
-    # Read mapping from CSV file
-    drum_mapping = appconfig.read_mapping(csv_path)
+    # Return arguments
+    return argparse.Namespace(infile=infile, outfile=outfile, **args)
+
+
+@pytest.fixture(scope="module", name="sample_csv")
+def fixture_sample_csv(tmp_path_factory):
+    """Write a simple MIDI drum mapping CSV file shared by the tests in this module."""
+
+    return write_sample_csv(tmp_path_factory.mktemp("data") / "mapping.csv")
+
+
+@pytest.fixture(scope="module", name="sample_midi")
+def fixture_sample_midi(tmp_path_factory):
+    """Create a simple MIDI file shared by the tests in this module."""
+
+    return create_simple_midi(tmp_path_factory.mktemp("data") / "infile.mid")
+
+
+@pytest.fixture(scope="module", name="multitrack_midi")
+def fixture_multitrack_midi(tmp_path_factory):
+    """Create a two-track MIDI file shared by the tests in this module."""
+
+    return create_multitrack_midi(tmp_path_factory.mktemp("data") / "multitrack.mid")
+
+
+@pytest.fixture(scope="module", name="drum_mapping")
+def fixture_drum_mapping(sample_csv):
+    """Read the shared MIDI drum mapping CSV file once for the tests in this module."""
+
+    return read_mapping(str(sample_csv))
+
+
+def test_convert_midi_basic_mapping(drum_mapping, sample_midi, tmp_path):
+    """Test converting MIDI mapping."""
+
+    # Declare variables
+    outfile = tmp_path / "outfile.mid"  # Output MIDI file
 
     # Initialize MIDIHandler
-    args = argparse.Namespace(
-        infile=infile_path,
-        outfile=outfile_path,
-        force_percussion=False,
-        preserve_meta=True,
-        remove_duplicates=False,
-        tempo=None,
-        time_signature=None
-    )
+    args = make_args(sample_midi, outfile)
     midihandler = MIDIHandler(args, drum_mapping)
 
     # Convert MIDI file with default flags
-    midihandler = midihandler.process_file(infile=infile, outfile=outfile)
+    midihandler.process_file(infile=str(sample_midi), outfile=str(outfile))
 
     # Verify output file exists and contains expected messages
-    assert outfile_path.exists()
+    assert outfile.exists()
     outfile_midi = mido.MidiFile(outfile)
 
-    # Loop tracks from MIDI file
-    for track in outfile_midi.tracks:
-
-        # Loop messages from track
-        for msg in track:
-
-            # Skip meta messages
-            if msg.is_meta:
-                continue
-
-            # Append other messages
-            messages.append(msg)
+    # Collect note messages from all tracks
+    messages = note_messages(outfile_midi)
 
     # Find messages by type/note
-    note36_msgs = [m for m in messages if getattr(m, "note", None) == 36]
-    note40_msgs = [m for m in messages if getattr(m, "note", None) == 40]
+    note36_msgs = [m for m in messages if m.note == 36]
+    note40_msgs = [m for m in messages if m.note == 40]
 
     # Check note message counts
     assert len(note36_msgs) >= 2
@@ -156,62 +294,165 @@ def test_convert_midi_basic_mapping(tmp_path):
     assert any(m.channel == 0 for m in note40_msgs)
 
 
-def test_convert_midi_force_percussion(tmp_path):
+def test_convert_midi_force_percussion(drum_mapping, sample_midi, tmp_path):
     """Test MIDI conversion parameter for forcing percussion"""
 
     # Declare variables
-    csv_path: str = os.path.join(tmp_path, "mapping.csv")  # CSV drum mapping
-    infile: str = os.path.join(tmp_path, "infile.mid")  # Input MIDI file
-    infile_path = Path(infile)  # Input MIDI file Path object
-    outfile: str = os.path.join(tmp_path, "outfile.mid")  # Output MIDI file
-    outfile_path = Path(outfile)  # Output MIDI file Path object
+    outfile = tmp_path / "outfile.mid"  # Output MIDI file
     mapped_notes = [36, 40]  # Expected mapped note values
-    messages: list = []  # MIDI messages
 
-    # Initialize AppConfig
-    appconfig = AppConfig()
+    # Initialize MIDIHandler
+    args = make_args(sample_midi, outfile, force_percussion=True)
+    midihandler = MIDIHandler(args, drum_mapping)
+
+    # Convert MIDI file with "force_percussion" and "preserve_meta" enabled
+    midihandler.process_file(infile=str(sample_midi), outfile=str(outfile))
+
+    # Create a new output MIDI file
+    outfile_midi = mido.MidiFile(outfile)
+
+    # Collect note messages from all tracks
+    messages = note_messages(outfile_midi)
+
+    # All mapped messages should be on percussion channel (9)
+    for msg in messages:
+        if msg.note in mapped_notes:
+            assert msg.channel == 9
+
+
+def test_midihandler_rejects_invalid_drum_map():
+    """Test that MIDIHandler rejects drum mappings outside the MIDI note range."""
 
-    # Generate a sample drum mapping CSV file
-    write_sample_csv(csv_path)
+    # Check both output and input notes
+    with pytest.raises(ValueError):
+        MIDIHandler(argparse.Namespace(), {36: 200})
+    with pytest.raises(ValueError):
+        MIDIHandler(argparse.Namespace(), {200: 36})
 
-    # Read mapping from CSV file
-    drum_mapping = appconfig.read_mapping(csv_path)
 
-    # Generate a sample MIDI file
-    create_simple_midi(infile)
+def test_convert_midi_remove_duplicates(drum_mapping, sample_midi, tmp_path):
+    """Test MIDI conversion parameter for removing duplicate notes."""
+
+    # Declare variables
+    outfile = tmp_path / "outfile.mid"  # Output MIDI file
 
     # Initialize MIDIHandler
-    args = argparse.Namespace(
-        infile=infile_path,
-        outfile=outfile_path,
-        force_percussion=True,
-        preserve_meta=True,
-        remove_duplicates=False,
-        tempo=None,
-        time_signature=None
-    )
+    args = make_args(sample_midi, outfile, remove_duplicates=True)
     midihandler = MIDIHandler(args, drum_mapping)
 
-    # Convert MIDI file with "force_percussion" and "preserve_meta" enabled
-    midihandler.process_file(infile=infile, outfile=outfile)
+    # Convert MIDI file with "remove_duplicates" enabled
+    midihandler.process_file(infile=str(sample_midi), outfile=str(outfile))
 
-    # Create a new output MIDI file
-    outfile_midi = mido.MidiFile(outfile)
+    # Collect note messages from all tracks
+    messages = note_messages(mido.MidiFile(outfile))
+    note36_msgs = [m for m in messages if m.note == 36]
 
-    # Loop tracks from MIDI file
-    for track in outfile_midi.tracks:
+    # The duplicate note_on is dropped, the note_on after a note_off is kept
+    assert [m.type for m in note36_msgs] == [
+        "note_on", "note_off", "note_on", "note_off", "note_on", "note_off"
+    ]
 
-        # Loop messages from track
-        for msg in track:
+    # Other notes are not affected
+    assert len([m for m in messages if m.note == 40]) == 2
 
-            # Skip meta messages
-            if msg.is_meta:
-                continue
 
-            # Append other messages
-            messages.append(msg)
+def test_convert_midi_discard_unmapped(drum_mapping, sample_midi, tmp_path):
+    """Test MIDI conversion parameter for discarding unmapped notes."""
 
-    # All mapped messages should be on percussion channel (9)
-    for msg in messages:
-        if getattr(msg, "note", None) in mapped_notes:
-            assert msg.channel == 9
+    # Declare variables
+    outfile = tmp_path / "outfile.mid"  # Output MIDI file
+
+    # Initialize MIDIHandler
+    args = make_args(sample_midi, outfile, discard_unmapped=True)
+    midihandler = MIDIHandler(args, drum_mapping)
+
+    # Convert MIDI file with "discard_unmapped" enabled
+    midihandler.process_file(infile=str(sample_midi), outfile=str(outfile))
+
+    # Collect note messages from all tracks
+    messages = note_messages(mido.MidiFile(outfile))
+
+    # Unmapped note 42 is removed, mapped notes are kept
+    assert not [m for m in messages if m.note == 42]
+    assert len([m for m in messages if m.note == 36]) == 7
+    assert len([m for m in messages if m.note == 40]) == 2
+
+
+def test_convert_midi_passes_unchanged_track(drum_mapping, multitrack_midi, tmp_path):
+    """Test that a track without mapped notes is passed on unchanged."""
+
+    # Declare variables
+    outfile = tmp_path / "outfile.mid"  # Output MIDI file
+    unmapped_track = mido.MidiFile(multitrack_midi).tracks[1]
+
+    # Initialize MIDIHandler
+    midihandler = MIDIHandler(make_args(multitrack_midi, outfile), drum_mapping)
+
+    # The track is returned as-is and written unchanged
+    assert midihandler._process_track(unmapped_track) is unmapped_track  # pylint: disable=W0212
+    midihandler.process_file(infile=str(multitrack_midi), outfile=str(outfile))
+    assert list(mido.MidiFile(outfile).tracks[1]) == list(unmapped_track)
+
+    # Discarding unmapped notes removes every note from the track
+    midihandler = MIDIHandler(make_args(multitrack_midi, outfile, discard_unmapped=True),
+                              drum_mapping)
+    messages = midihandler._process_track(unmapped_track)  # pylint: disable=W0212
+    assert messages is not unmapped_track
+    assert not [m for m in messages if m.type in _NOTE_TYPES]
+
+    # Forcing percussion moves every note onto the percussion channel
+    midihandler = MIDIHandler(make_args(multitrack_midi, outfile, force_percussion=True),
+                              drum_mapping)
+    messages = midihandler._process_track(unmapped_track)  # pylint: disable=W0212
+    assert messages is not unmapped_track
+    assert all(m.channel == 9 for m in messages if m.type in _NOTE_TYPES)
+
+
+def test_convert_midi_inserts_meta(drum_mapping, multitrack_midi, tmp_path):
+    """Test that user-specified metas replace source metas in a multi-track MIDI file."""
+
+    # Declare variables
+    outfile = tmp_path / "outfile.mid"  # Output MIDI file
+    tempo = mido.bpm2tempo(140.0)  # Expected tempo
+
+    # Initialize MIDIHandler
+    args = make_args(multitrack_midi, outfile, preserve_meta=False, tempo=140,
+                     time_signature=(7, 4))
+    midihandler = MIDIHandler(args, drum_mapping)
+
+    # Convert MIDI file with tempo and time signature
+    midihandler.process_file(infile=str(multitrack_midi), outfile=str(outfile))
+    outfile_midi = mido.MidiFile(outfile)
+    assert len(outfile_midi.tracks) == 2
+
+    # Inserted metas are only in track 0, source metas are dropped from every track
+    metas = [
+        [m for m in track if m.is_meta and m.type != "end_of_track"]
+        for track in outfile_midi.tracks
+    ]
+    assert metas[0] == [
+        mido.MetaMessage("set_tempo", tempo=tempo, time=0),
+        mido.MetaMessage("time_signature", numerator=7, denominator=4, time=0),
+    ]
+    assert not metas[1]
+
+    # Notes are kept in both tracks
+    assert [m.note for m in outfile_midi.tracks[1] if m.type in _NOTE_TYPES] == [42, 42, 46, 46]
+    assert len(note_messages(outfile_midi)) == len(_SAMPLE_NOTES) + len(_UNMAPPED_NOTES)
+
+
+def test_convert_midi_streaming_write(drum_mapping, multitrack_midi, tmp_path):
+    """Test that streaming write produces the same output MIDI file as the in-memory write."""
+
+    # Convert MIDI file once with each write mode
+    outfiles = []
+    for streaming_write in (False, True):
+        outfile = tmp_path / f"outfile_{streaming_write}.mid"
+        args = make_args(multitrack_midi, outfile, streaming_write=streaming_write)
+        MIDIHandler(args, drum_mapping).process_file(
+            infile=str(multitrack_midi), outfile=str(outfile)
+        )
+        outfiles.append(outfile)
+
+    # Output MIDI files are byte-identical
+    assert outfiles[0].read_bytes() == outfiles[1].read_bytes()